@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for the bot's hot helpers.
+
+Runs each helper against a temporary database pre-filled with --users users
+and --spins spins, prints ns/op, and compares with a JSON baseline.
+
+    python bench.py --save                 # record bench_baseline.json
+    python bench.py                        # compare, exit 1 on regression
+    python bench.py --threshold 10 --users 100000 --spins 1000000
+    python bench.py --backend memory --only cfg_get,pick_weighted
+
+Each helper is timed in --repeat runs of at least --min-time seconds. The
+median is compared, and the run-to-run spread is stored with the baseline. A
+helper regresses when its median is more than --threshold percent slower than
+the baseline and also slower by more than the spread of either run.
+
+Expect noise. On a shared 1-vCPU VM the spread within one run was 20-55%.
+Medians moved by up to +/-48% between runs on an unchanged tree, worst for
+the sub-microsecond helpers (cfg_get, ensure_user). So the default threshold
+is 50%. Use a lower one only on a quiet, dedicated machine where the printed
+noise column stays small. Baselines are machine specific; record them on the
+machine you compare on.
+"""
+
+import os
+import sys
+import json
+import random
+import sqlite3
+import statistics
+import argparse
+import tempfile
+import timeit
+from datetime import datetime, date, timedelta
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+import bot
+from storage import MemoryStorage, SQLiteStorage, open_storage
+
+# Default allowed slowdown in percent; see the module docstring for the noise.
+THRESHOLD = 50.0
+
+
+def prefill(store, users: int, spins: int) -> None:
+    now = datetime.utcnow().isoformat()
+    today = date.today().isoformat()
+    user_rows = [
+        (uid, f"user{uid}", f"User {uid}", None, 1, 1_000_000_000, today, now)
+        for uid in range(1, users + 1)
+    ]
+    spin_rows = [
+        (random.randint(1, users), "free", 0, "lose", "", now)
+        for _ in range(spins)
+    ]
+    if isinstance(store, SQLiteStorage):
+        con = sqlite3.connect(store.path)
+        con.executemany(
+            "INSERT INTO users(user_id, username, first_name, referrer_id, free_spins, paid_spins, "
+            "last_free_date, created_at) VALUES(?,?,?,?,?,?,?,?)",
+            user_rows,
+        )
+        con.executemany(
+            "INSERT INTO spins(user_id, used_type, result_idx, result_name, result_sticker, created_at) "
+            "VALUES(?,?,?,?,?,?)",
+            spin_rows,
+        )
+        con.commit()
+        con.close()
+    elif isinstance(store, MemoryStorage):
+        cols = ("user_id", "username", "first_name", "referrer_id", "free_spins", "paid_spins",
+                "last_free_date", "created_at")
+        for row in user_rows:
+            store.users[row[0]] = dict(zip(cols, row), referral_count=0)
+        store.spins.extend(spin_rows)
+    else:
+        raise SystemExit(f"Don't know how to prefill {type(store).__name__}")
+
+
+def cases(users: int) -> Dict[str, Callable[[], object]]:
+    """name -> zero-argument callable doing one operation."""
+    uids = list(range(1, users + 1))
+    random.shuffle(uids)
+    it = {"i": 0}
+
+    def next_uid() -> int:
+        it["i"] = (it["i"] + 1) % len(uids)
+        return uids[it["i"]]
+
+    people = {uid: SimpleNamespace(id=uid, username=f"user{uid}", first_name=f"User {uid}") for uid in uids}
+    outcomes = bot.load_outcomes()
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    lose = bot.get_sampler()["outcomes"][0]
+
+    def cfg_get_cold():
+        bot.CFG_CACHE.clear()
+        return bot.cfg_get("lose_weight")
+
+    def ensure_user_cold():
+        uid = next_uid()
+        bot.USER_CACHE.pop(uid, None)
+        bot.ensure_user(people[uid])
+
+    def refresh_daily_free_reset():
+        uid = next_uid()
+        bot.get_user(uid)
+        bot.user_cache_update(uid, last_free_date=yesterday)
+        bot.refresh_daily_free(uid)
+
+    def main_menu_text():
+        return bot.main_menu_text(bot.get_user(next_uid()))
+
+    return {
+        "cfg_get": lambda: bot.cfg_get("lose_weight"),
+        "cfg_get_cold": cfg_get_cold,
+        "load_outcomes": bot.load_outcomes,
+        "pick_weighted": lambda: bot.pick_weighted(outcomes),
+        "sample": lambda: bot.sample(bot.get_sampler()),
+        "ensure_user": lambda: bot.ensure_user(people[next_uid()]),
+        "ensure_user_cold": ensure_user_cold,
+        "refresh_daily_free": lambda: bot.refresh_daily_free(next_uid()),
+        "refresh_daily_free_reset": refresh_daily_free_reset,
+        "commit_spin": lambda: bot.commit_spin(next_uid(), "paid", 1, lose),
+        "main_menu_text": main_menu_text,
+        "main_menu_kb": lambda: bot.main_menu_kb(next_uid()),
+    }
+
+
+def measure(fn: Callable[[], object], repeat: int, min_time: float) -> Dict[str, float]:
+    """Median ns/op over ``repeat`` timing runs and their spread in percent.
+
+    The spread is the run-to-run range ``(max - min) / median``; compare()
+    treats anything inside it as noise.
+    """
+    timer = timeit.Timer(fn)
+    timer.timeit(1000)  # warm the caches the helper touches
+    number, elapsed = timer.autorange()
+    while elapsed < min_time:
+        number *= 2
+        elapsed = timer.timeit(number)
+    runs = [t / number * 1e9 for t in timer.repeat(repeat=repeat, number=number)]
+    median = statistics.median(runs)
+    return {"median": median, "spread": (max(runs) - min(runs)) / median * 100}
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            threshold: float) -> List[str]:
+    """A helper regresses when its median is slower than the baseline by more
+    than ``threshold`` percent and by more than both runs' spread."""
+    regressions = []
+    print(f"\n{'helper':<26}{'baseline':>12}{'now':>12}{'change':>10}{'noise':>9}")
+    for name, now in results.items():
+        old = baseline.get(name)
+        if isinstance(old, (int, float)):  # baseline saved before spreads were recorded
+            old = {"median": old, "spread": 0.0}
+        if not old or not old.get("median"):
+            print(f"{name:<26}{'-':>12}{now['median']:>12.0f}{'new':>10}")
+            continue
+        change = (now["median"] - old["median"]) / old["median"] * 100
+        noise = max(old["spread"], now["spread"])
+        flag = ""
+        if change > max(threshold, noise):
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<26}{old['median']:>12.0f}{now['median']:>12.0f}{change:>+9.1f}%{noise:>8.1f}%{flag}")
+    return regressions
+
+
+def main(argv: List[str]) -> int:
+    p = argparse.ArgumentParser(description="Microbenchmarks for the bot's hot helpers.")
+    p.add_argument("--users", type=int, default=10_000)
+    p.add_argument("--spins", type=int, default=100_000)
+    p.add_argument("--backend", default="sqlite", help="sqlite | memory")
+    p.add_argument("--baseline", default="bench_baseline.json")
+    p.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    p.add_argument("--threshold", type=float, default=THRESHOLD, help="allowed slowdown in percent")
+    p.add_argument("--repeat", type=int, default=9, help="timing runs per helper (median is used)")
+    p.add_argument("--min-time", type=float, default=0.5, help="seconds per timing run")
+    p.add_argument("--only", default="", help="comma separated helper names")
+    p.add_argument("--seed", type=int, default=1)
+    args = p.parse_args(argv)
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bot.STORE = open_storage(args.backend, os.path.join(tmp, "bench.db"))
+        bot.init_db()
+        prefill(bot.STORE, args.users, args.spins)
+        bot.USER_CACHE_SIZE = max(bot.USER_CACHE_SIZE, args.users)
+
+        all_cases = cases(args.users)
+        names = [n.strip() for n in args.only.split(",") if n.strip()] or list(all_cases)
+        unknown = [n for n in names if n not in all_cases]
+        if unknown:
+            p.error(f"unknown helper(s): {', '.join(unknown)}")
+
+        print(f"backend={args.backend} users={args.users} spins={args.spins}")
+        results = {}
+        for name in names:
+            results[name] = measure(all_cases[name], args.repeat, args.min_time)
+            print(f"{name:<26}{results[name]['median']:>12.0f} ns/op  ±{results[name]['spread']:.1f}%")
+        bot.STORE.close()
+
+    if args.save:
+        data = {
+            "meta": {
+                "backend": args.backend,
+                "users": args.users,
+                "spins": args.spins,
+                "python": sys.version.split()[0],
+                "created_at": datetime.utcnow().isoformat(),
+            },
+            "results": results,
+        }
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --save first.")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    meta = baseline.get("meta", {})
+    if (meta.get("backend"), meta.get("users"), meta.get("spins")) != (args.backend, args.users, args.spins):
+        print(f"\nWarning: baseline was recorded with {meta}")
+    regressions = compare(results, baseline.get("results", {}), args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} helper(s) slower than {args.threshold:g}%: {', '.join(regressions)}")
+        return 1
+    print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -9,29 +9,48 @@ Buttons:
 - 🎁 Gifts (lists ONLY the 4 gifts: Frog, Hat, Bear, Rocket)
 - 🛒 Buy Spins (instructions + shows cost)
 - 🔗 Referral Link (shows link)
+- 🏆 Top Referrers (leaderboard + your rank)
 - 📣 Channel (URL button to required channel)
 - 👑 Admin Panel (only admins)
 
 Admin can change required channel and other settings.
+
+Storage: STORAGE_BACKEND=sqlite (default, DB_PATH) or memory (see storage.py)
+
+Odds report (needs numpy, pip install -r requirements-sim.txt):
+                           python bot.py simulate [--draws N] [--seed S]
+Self-checks:               python check.py outbox | stress-stock
+Microbenchmarks:           python bench.py [--save] [--threshold PCT]
 """
 
 import os
-import sqlite3
+import sys
+import time
 import random
 import asyncio
-from datetime import datetime, date
+import json
+import logging
+import argparse
+import bisect
+from collections import OrderedDict
+from datetime import datetime, date, timedelta
 from typing import List, Dict, Optional
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, BadRequest, NetworkError, TelegramError
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
-    MessageHandler, ContextTypes, filters
+    MessageHandler, ContextTypes, filters,
+    BasePersistence, PersistenceInput,
 )
 
+from storage import Storage, open_storage
+
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 OWNER_ID = int(os.getenv("OWNER_ID", "0") or "0")
 DB_PATH = os.getenv("DB_PATH", "gift_roulette.db").strip()
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").strip()  # sqlite | memory
 
 ADMIN_IDS = set()
 raw_admins = (os.getenv("ADMIN_IDS", "") or "").strip()
@@ -43,200 +62,169 @@ if raw_admins:
 if OWNER_ID:
     ADMIN_IDS.add(OWNER_ID)
 
+# Outbound queue limits (Telegram allows ~30 msg/s overall, ~1 msg/s per chat)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4") or "4")
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25") or "25")
+OUTBOX_CHAT_INTERVAL = float(os.getenv("OUTBOX_CHAT_INTERVAL", "1.0") or "1.0")
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "5") or "5")
 
-def db() -> sqlite3.Connection:
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    return con
+# Monte Carlo draws for the admin odds simulator
+SIM_DRAWS = int(os.getenv("SIM_DRAWS", "10000000") or "10000000")
 
+# Bounded write-through cache of user rows
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000") or "10000")
 
-def table_columns(con: sqlite3.Connection, table: str) -> set:
-    cur = con.cursor()
-    cur.execute(f"PRAGMA table_info({table})")
-    return {row[1] for row in cur.fetchall()}
+# Persisted user_data (admin input state): flush interval and idle eviction, seconds
+PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL", "30") or "30")
+USER_DATA_TTL = float(os.getenv("USER_DATA_TTL", "86400") or "86400")
 
+# Rows on the Top Referrers screen
+TOP_REFERRERS_N = int(os.getenv("TOP_REFERRERS_N", "10") or "10")
 
-def ensure_column(con: sqlite3.Connection, table: str, col: str, col_type: str, default_sql: str = "") -> None:
-    if col in table_columns(con, table):
-        return
-    cur = con.cursor()
-    sql = f"ALTER TABLE {table} ADD COLUMN {col} {col_type}"
-    if default_sql:
-        sql += f" DEFAULT {default_sql}"
-    cur.execute(sql)
+# Menu buttons edit the pressed message instead of posting a new one
+MENU_EDIT_IN_PLACE = (os.getenv("MENU_EDIT_IN_PLACE", "1") or "1").strip() != "0"
 
+log = logging.getLogger("gift_roulette")
 
-def init_db() -> None:
-    con = db()
-    cur = con.cursor()
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS config(
-      key TEXT PRIMARY KEY,
-      value TEXT NOT NULL
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users(
-      user_id INTEGER PRIMARY KEY,
-      username TEXT,
-      first_name TEXT,
-      referrer_id INTEGER,
-      free_spins INTEGER NOT NULL DEFAULT 0,
-      paid_spins INTEGER NOT NULL DEFAULT 0,
-      last_free_date TEXT,
-      created_at TEXT NOT NULL
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS spins(
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      user_id INTEGER NOT NULL,
-      used_type TEXT NOT NULL,
-      result_idx INTEGER NOT NULL,
-      result_name TEXT NOT NULL,
-      result_sticker TEXT,
-      created_at TEXT NOT NULL
-    )
-    """)
-
-    # Auto-migrate
-    ensure_column(con, "users", "username", "TEXT")
-    ensure_column(con, "users", "first_name", "TEXT")
-    ensure_column(con, "users", "referrer_id", "INTEGER")
-    ensure_column(con, "users", "free_spins", "INTEGER", "0")
-    ensure_column(con, "users", "paid_spins", "INTEGER", "0")
-    ensure_column(con, "users", "last_free_date", "TEXT")
-    ensure_column(con, "users", "created_at", "TEXT")
-
-    ensure_column(con, "spins", "used_type", "TEXT")
-    ensure_column(con, "spins", "result_idx", "INTEGER")
-    ensure_column(con, "spins", "result_name", "TEXT")
-    ensure_column(con, "spins", "result_sticker", "TEXT")
-    ensure_column(con, "spins", "created_at", "TEXT")
-
-    con.commit()
-
-    defaults = {
-        "required_channel": "@YOUR_CHANNEL",
-        "daily_free_spins": "1",
-        "ref_bonus_spins": "1",
-        "spin_cost_paid": "1",
-
-        "contact_username": "@YourUsername",
-        "lose_name": "❌ Better luck next time 🍀",
-        "lose_weight": "999996",
-
-        "gift1_name": "🐸 Frog",
-        "gift1_weight": "1",
-        "gift1_sticker": "CAACAgQAAxkBAANDaVwubFAKAbQ0B995A7Z_uVQwRkQAAlEVAAKRsGhSdWvnThzmAT44BA",
-
-        "gift2_name": "🎩 Hat",
-        "gift2_weight": "1",
-        "gift2_sticker": "CAACAgQAAxkBAAMwaVu0TKSGzZ1Toee912YYD09c8ZUAAsEXAAJJOhhS-kc7biMyTbM4BA",
-
-        "gift3_name": "🧸 Bear",
-        "gift3_weight": "1",
-        "gift3_sticker": "CAACAgQAAxkBAANHaVwuc5sIOGwIJ5WCvTBvbs6THcgAAr8VAALCaChRf_q3xzMsSfY4BA",
-
-        "gift4_name": "🚀 Rocket",
-        "gift4_weight": "1",
-        "gift4_sticker": "CAACAgQAAxkBAANJaVwuhGDyQolwEtGYj7lUJmFNzAwAAvUhAAKSvChRB_8-1v1glj84BA",
-    }
-    for k, v in defaults.items():
-        cur.execute("INSERT OR IGNORE INTO config(key,value) VALUES(?,?)", (k, v))
+CONFIG_DEFAULTS = {
+    "required_channel": "@YOUR_CHANNEL",
+    "daily_free_spins": "1",
+    "ref_bonus_spins": "1",
+    "spin_cost_paid": "1",
+
+    "contact_username": "@YourUsername",
+    "lose_name": "❌ Better luck next time 🍀",
+    "lose_weight": "999996",
+
+    "gift1_name": "🐸 Frog",
+    "gift1_weight": "1",
+    "gift1_sticker": "CAACAgQAAxkBAANDaVwubFAKAbQ0B995A7Z_uVQwRkQAAlEVAAKRsGhSdWvnThzmAT44BA",
+
+    "gift2_name": "🎩 Hat",
+    "gift2_weight": "1",
+    "gift2_sticker": "CAACAgQAAxkBAAMwaVu0TKSGzZ1Toee912YYD09c8ZUAAsEXAAJJOhhS-kc7biMyTbM4BA",
 
-    con.commit()
-    con.close()
+    "gift3_name": "🧸 Bear",
+    "gift3_weight": "1",
+    "gift3_sticker": "CAACAgQAAxkBAANHaVwuc5sIOGwIJ5WCvTBvbs6THcgAAr8VAALCaChRf_q3xzMsSfY4BA",
+
+    "gift4_name": "🚀 Rocket",
+    "gift4_weight": "1",
+    "gift4_sticker": "CAACAgQAAxkBAANJaVwuhGDyQolwEtGYj7lUJmFNzAwAAvUhAAKSvChRB_8-1v1glj84BA",
+}
+GIFT_COUNT = 4
+
+# All persistence goes through STORE; see storage.py for the backends.
+STORE: Storage = open_storage(STORAGE_BACKEND, DB_PATH)
+
+# Config is tiny and only changed through cfg_set, so it is read once and kept.
+CFG_CACHE: Dict[str, str] = {}
+
+# user_id -> row dict, most recently used last. Every mutation below writes the
+# new values through, so reads never need to go back to storage for a cached user.
+USER_CACHE: "OrderedDict[int, dict]" = OrderedDict()
+USER_CACHE_STATS = {"hits": 0, "misses": 0}
+
+
+def init_db() -> None:
+    STORE.init(CONFIG_DEFAULTS, GIFT_COUNT)
+    CFG_CACHE.clear()
+    USER_CACHE.clear()
+    invalidate_sampler()
 
 
 def cfg_get(key: str) -> str:
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT value FROM config WHERE key=?", (key,))
-    r = cur.fetchone()
-    con.close()
-    return r["value"] if r else ""
+    if not CFG_CACHE:
+        CFG_CACHE.update(STORE.config_all())
+    return CFG_CACHE.get(key, "")
 
 
 def cfg_set(key: str, value: str) -> None:
-    con = db()
-    cur = con.cursor()
-    cur.execute(
-        "INSERT INTO config(key,value) VALUES(?,?) "
-        "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-        (key, value),
-    )
-    con.commit()
-    con.close()
+    STORE.config_set(key, value)
+    if CFG_CACHE:
+        CFG_CACHE[key] = value
+    invalidate_sampler()
+
+
+def user_cache_put(row: Optional[dict]) -> None:
+    if row is None:
+        return
+    user_id = row["user_id"]
+    USER_CACHE[user_id] = row
+    USER_CACHE.move_to_end(user_id)
+    while len(USER_CACHE) > USER_CACHE_SIZE:
+        USER_CACHE.popitem(last=False)
+
+
+def user_cache_update(user_id: int, **changes) -> None:
+    # Rows are replaced, never mutated, so a dict handed out earlier stays a snapshot.
+    row = USER_CACHE.get(user_id)
+    if row is not None:
+        USER_CACHE[user_id] = {**row, **changes}
+
+
+def user_cache_add(user_id: int, col: str, delta: int) -> None:
+    row = USER_CACHE.get(user_id)
+    if row is not None:
+        user_cache_update(user_id, **{col: row[col] + delta})
 
 
 def ensure_user(u) -> None:
-    con = db()
-    cur = con.cursor()
-    cur.execute(
-        "INSERT OR IGNORE INTO users(user_id, username, first_name, created_at) VALUES(?,?,?,?)",
-        (u.id, u.username or "", u.first_name or "", datetime.utcnow().isoformat()),
-    )
-    cur.execute("UPDATE users SET username=?, first_name=? WHERE user_id=?", (u.username or "", u.first_name or "", u.id))
-    con.commit()
-    con.close()
+    username, first_name = u.username or "", u.first_name or ""
+    cached = USER_CACHE.get(u.id)
+    if cached is not None and cached["username"] == username and cached["first_name"] == first_name:
+        return
+    user_cache_put(STORE.ensure_user(u.id, username, first_name, datetime.utcnow().isoformat()))
 
 
-def get_user(user_id: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    r = cur.fetchone()
-    con.close()
-    return r
+def get_user(user_id: int) -> Optional[dict]:
+    row = USER_CACHE.get(user_id)
+    if row is not None:
+        USER_CACHE_STATS["hits"] += 1
+        USER_CACHE.move_to_end(user_id)
+        return row
+    USER_CACHE_STATS["misses"] += 1
+    row = STORE.get_user(user_id)
+    user_cache_put(row)
+    return row
 
 
 def set_referrer_if_empty(user_id: int, referrer_id: int) -> bool:
     if referrer_id == user_id:
         return False
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT referrer_id FROM users WHERE user_id=?", (user_id,))
-    r = cur.fetchone()
-    if not r or r["referrer_id"] is not None:
-        con.close()
+    if not STORE.set_referrer_if_empty(user_id, referrer_id):
         return False
-    cur.execute("UPDATE users SET referrer_id=? WHERE user_id=?", (referrer_id, user_id))
-    con.commit()
-    con.close()
+    user_cache_update(user_id, referrer_id=referrer_id)
+    user_cache_add(referrer_id, "referral_count", 1)
     return True
 
 
+def top_referrers(limit: int) -> List[dict]:
+    return STORE.top_referrers(limit)
+
+
+def referral_rank(user_id: int) -> Optional[int]:
+    return STORE.referral_rank(user_id)
+
+
 def add_free_spins(user_id: int, amount: int) -> None:
-    con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE users SET free_spins = free_spins + ? WHERE user_id=?", (amount, user_id))
-    con.commit()
-    con.close()
+    STORE.add_spins(user_id, free=amount)
+    user_cache_add(user_id, "free_spins", amount)
 
 
 def add_paid_spins(user_id: int, amount: int) -> None:
-    con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE users SET paid_spins = paid_spins + ? WHERE user_id=?", (amount, user_id))
-    con.commit()
-    con.close()
+    STORE.add_spins(user_id, paid=amount)
+    user_cache_add(user_id, "paid_spins", amount)
 
 
 def refresh_daily_free(user_id: int) -> None:
     daily = int(cfg_get("daily_free_spins") or "0")
     today = date.today().isoformat()
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT last_free_date FROM users WHERE user_id=?", (user_id,))
-    r = cur.fetchone()
+    r = get_user(user_id)
     if r and r["last_free_date"] != today:
-        cur.execute("UPDATE users SET free_spins=?, last_free_date=? WHERE user_id=?", (daily, today, user_id))
-        con.commit()
-    con.close()
+        STORE.reset_daily_free(user_id, daily, today)
+        user_cache_update(user_id, free_spins=daily, last_free_date=today)
 
 
 def load_outcomes() -> List[Dict]:
@@ -247,7 +235,7 @@ def load_outcomes() -> List[Dict]:
         "sticker": None,
     }
     gifts = []
-    for i in range(1, 5):
+    for i in range(1, GIFT_COUNT + 1):
         gifts.append({
             "idx": i,
             "name": (cfg_get(f"gift{i}_name") or f"Gift {i}").strip(),
@@ -273,18 +261,398 @@ def pick_weighted(outcomes: List[Dict]) -> Dict:
     return outcomes[0]
 
 
-async def send_spin_animation(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+# ---------------- Gift stock ----------------
+# The spin sampler (cumulative weights over the outcomes) is built once and
+# reused until the stock state changes: a gift sells out, a restock is due, or
+# an admin edits weights/stock. Sold-out gifts have their weight folded into
+# the lose outcome, so they are never drawn while empty.
+
+SAMPLER: Dict = {"sampler": None}
+
+
+def invalidate_sampler() -> None:
+    SAMPLER["sampler"] = None
+
+
+def restock_due(stock: Dict[int, dict], now: datetime) -> Optional[datetime]:
+    """Refill gifts whose restock time has passed; return the next restock time."""
+    next_at = None
+    for row in stock.values():
+        if row["capacity"] is None or row["restock_days"] <= 0:
+            continue
+        period = timedelta(days=row["restock_days"])
+        last = datetime.fromisoformat(row["restocked_at"]) if row["restocked_at"] else None
+        if last is None or last + period <= now:
+            if STORE.restock(row["idx"], row["restocked_at"], now.isoformat()):
+                row["remaining"], row["restocked_at"] = row["capacity"], now.isoformat()
+            last = now
+        if next_at is None or last + period < next_at:
+            next_at = last + period
+    return next_at
+
+
+def build_sampler() -> Dict:
+    outcomes = [dict(o) for o in load_outcomes()]
+    now = datetime.utcnow()
+    stock = STORE.load_stock()
+    expires = restock_due(stock, now)
+
+    lose = outcomes[0]
+    for o in outcomes[1:]:
+        row = stock.get(o["idx"])
+        o["limited"] = bool(row and row["capacity"] is not None)
+        o["remaining"] = row["remaining"] if o["limited"] else None
+        if o["limited"] and o["remaining"] <= 0:
+            lose["weight"] += o["weight"]
+            o["weight"] = 0
+
+    cum = []
+    total = 0
+    for o in outcomes:
+        total += o["weight"]
+        cum.append(total)
+    return {"outcomes": outcomes, "cum": cum, "total": total, "expires": expires}
+
+
+def get_sampler() -> Dict:
+    sampler = SAMPLER["sampler"]
+    if sampler is None or (sampler["expires"] is not None and datetime.utcnow() >= sampler["expires"]):
+        sampler = build_sampler()
+        SAMPLER["sampler"] = sampler
+    return sampler
+
+
+def sample(sampler: Dict) -> Dict:
+    r = random.randint(1, sampler["total"])
+    return sampler["outcomes"][bisect.bisect_left(sampler["cum"], r)]
+
+
+def load_stock() -> Dict[int, dict]:
+    return STORE.load_stock()
+
+
+def set_gift_stock(idx: int, capacity: Optional[int], restock_days: int = 0) -> None:
+    STORE.set_gift_stock(idx, capacity, restock_days, datetime.utcnow().isoformat())
+    invalidate_sampler()
+
+
+def commit_spin(user_id: int, used_type: str, cost: int, outcome: Dict) -> Optional[Dict]:
+    """Debit the spin, take the gift from stock and record the spin in one transaction.
+
+    Returns the outcome actually awarded (the lose outcome if the gift sold out
+    in the meantime), or None if the user no longer has the balance.
+    """
+    lose = get_sampler()["outcomes"][0]
+    res = STORE.commit_spin(user_id, used_type, cost, outcome, lose, datetime.utcnow().isoformat())
+    if res is None:
+        return None
+    outcome, sold_out = res
+    if sold_out:
+        invalidate_sampler()
+    if used_type == "free":
+        user_cache_add(user_id, "free_spins", -1)
+    else:
+        user_cache_add(user_id, "paid_spins", -cost)
+    return outcome
+
+
+def simulate_outcomes(outcomes: List[Dict], draws: int = SIM_DRAWS, seed: Optional[int] = None,
+                      chunk: int = 2_000_000) -> Dict:
+    """Draw ``draws`` spins with NumPy using the same integer weights as pick_weighted."""
+    try:
+        import numpy as np
+    except ImportError:
+        raise RuntimeError("The simulator needs numpy (pip install -r requirements-sim.txt).")
+
+    weights = np.array([o["weight"] for o in outcomes], dtype=np.int64)
+    cum = np.cumsum(weights)
+    total = int(cum[-1])
+    if total <= 0 or draws <= 0:
+        raise ValueError("Nothing to simulate")
+
+    started = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    counts = np.zeros(len(outcomes), dtype=np.int64)
+    left = draws
+    while left > 0:
+        n = min(left, chunk)
+        r = rng.integers(0, total, size=n)
+        counts += np.bincount(np.searchsorted(cum, r, side="right"), minlength=len(outcomes))
+        left -= n
+    elapsed = time.perf_counter() - started
+
+    # Wilson score interval, 95%
+    z = 1.96
+    p_hat = counts / draws
+    denom = 1 + z * z / draws
+    centre = (p_hat + z * z / (2 * draws)) / denom
+    half = z * np.sqrt(p_hat * (1 - p_hat) / draws + z * z / (4 * draws * draws)) / denom
+
+    rows = []
+    for i, o in enumerate(outcomes):
+        rows.append({
+            "idx": o["idx"],
+            "name": o["name"],
+            "weight": int(weights[i]),
+            "count": int(counts[i]),
+            "theoretical": int(weights[i]) / total,
+            "empirical": float(p_hat[i]),
+            "ci_low": float(max(centre[i] - half[i], 0.0)),
+            "ci_high": float(min(centre[i] + half[i], 1.0)),
+        })
+    gifts = [r for r in rows if r["idx"] != 0]
+    return {
+        "draws": draws,
+        "seconds": elapsed,
+        "rows": rows,
+        "gifts_per_1000": 1000 * sum(r["theoretical"] for r in gifts),
+        "gifts_per_1000_empirical": 1000 * sum(r["count"] for r in gifts) / draws,
+    }
+
+
+def format_sim_report(report: Dict, cost: int = 1) -> str:
+    lines = [f"{report['draws']:,} spins in {report['seconds']:.2f}s", ""]
+    for r in report["rows"]:
+        lines.append(f"{r['name']} (w={r['weight']})")
+        lines.append(f"  theory {r['theoretical']:.6g} | sim {r['empirical']:.6g} ({r['count']:,})")
+        lines.append(f"  95% CI [{r['ci_low']:.3e}, {r['ci_high']:.3e}]")
+    lines.append("")
+    per_1000 = report["gifts_per_1000"]
+    lines.append(f"Gifts per 1,000 paid spins: {per_1000:.4g} (sim {report['gifts_per_1000_empirical']:.4g})")
+    if per_1000 > 0:
+        lines.append(f"Balance taken per gift paid: {cost * 1000 / per_1000:,.0f}")
+    return "\n".join(lines)
+
+
+# ---------------- Outbound queue ----------------
+# Handlers never await the Telegram API for messages: they enqueue a job and
+# return. Workers drain the queue by priority, respecting a global rate, a
+# per-chat interval and RetryAfter pauses. Jobs sharing a coalesce key for the
+# same chat (menu re-renders) only deliver the newest one.
+
+PRIO_RESULT = 0      # spin animation, prize sticker, spin result
+PRIO_MENU = 1        # menus and replies to button presses
+PRIO_REFERRAL = 2    # notifications to other users (referral bonus)
+PRIO_BROADCAST = 3   # bulk messages
+
+OUTBOX: Dict = {
+    "queue": None,
+    "seq": 0,
+    "next_slot": 0.0,
+    "paused_until": 0.0,
+    "chat_ready": {},
+    "latest": {},
+    "parked": {},
+    "busy": 0,
+    "tasks": [],
+}
+
+
+def outbox_queue() -> asyncio.PriorityQueue:
+    if OUTBOX["queue"] is None:
+        OUTBOX["queue"] = asyncio.PriorityQueue()
+    return OUTBOX["queue"]
+
+
+def enqueue(method: str, chat_id: int, priority: int = PRIO_MENU, coalesce: Optional[str] = None,
+            hold: float = 0.0, fallback: Optional[tuple] = None, **kwargs) -> None:
+    """Queue ``bot.<method>(chat_id=chat_id, **kwargs)``.
+
+    ``hold`` keeps the chat quiet for that many extra seconds after the send
+    (used to let the dice animation play). ``fallback`` is a ``(method, kwargs)``
+    pair sent instead when the call is rejected by Telegram.
+    """
+    OUTBOX["seq"] += 1
+    seq = OUTBOX["seq"]
+    key = None
+    if coalesce:
+        key = (chat_id, coalesce)
+        OUTBOX["latest"][key] = seq
+    job = {
+        "method": method,
+        "chat_id": chat_id,
+        "kwargs": kwargs,
+        "coalesce": key,
+        "hold": hold,
+        "fallback": fallback,
+        "tries": 0,
+    }
+    outbox_queue().put_nowait((priority, seq, job))
+
+
+def reply(update: Update, text: str, priority: int = PRIO_MENU, coalesce: Optional[str] = None, **kwargs) -> None:
+    enqueue("send_message", update.effective_chat.id, priority, coalesce, text=text, **kwargs)
+
+
+# Last text/keyboard put on each menu message, so unchanged re-renders skip the API.
+RENDERED: "OrderedDict[tuple, tuple]" = OrderedDict()
+RENDERED_MAX = 5000
+
+
+def show_menu(update: Update, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, **kwargs) -> None:
+    """Show a menu screen, editing the pressed message in place when possible."""
+    q = update.callback_query
+    msg = q.message if q else None
+    if not MENU_EDIT_IN_PLACE or msg is None or not msg.text:
+        reply(update, text, coalesce="menu", reply_markup=reply_markup, **kwargs)
+        return
+
+    key = (msg.chat_id, msg.message_id)
+    last = RENDERED.get(key)
+    if last is None:
+        last = (msg.text_html, msg.reply_markup)
+    if last == (text, reply_markup):
+        return
+    RENDERED[key] = (text, reply_markup)
+    RENDERED.move_to_end(key)
+    while len(RENDERED) > RENDERED_MAX:
+        RENDERED.popitem(last=False)
+
+    # Keyed per message: an edit only supersedes older edits of the same message.
+    enqueue(
+        "edit_message_text", msg.chat_id, PRIO_MENU, f"menu:{msg.message_id}",
+        fallback=("send_message", dict(text=text, reply_markup=reply_markup, **kwargs)),
+        message_id=msg.message_id, text=text, reply_markup=reply_markup, **kwargs,
+    )
+
+
+def outbox_forget(job: Dict) -> None:
+    # An edit that never landed must not count as the message's current content.
+    if job["method"] == "edit_message_text":
+        RENDERED.pop((job["chat_id"], job["kwargs"]["message_id"]), None)
+
+
+def outbox_park(chat_id: int, item: tuple, delay: float) -> None:
+    # Jobs waiting for a busy chat; kept per chat so a cancelled hold can wake them early.
+    handle = asyncio.get_running_loop().call_later(delay, outbox_unpark, chat_id, item)
+    OUTBOX["parked"].setdefault(chat_id, {})[item[1]] = (handle, item)
+
+
+def outbox_unpark(chat_id: int, item: tuple) -> None:
+    parked = OUTBOX["parked"].get(chat_id)
+    if parked is not None:
+        parked.pop(item[1], None)
+        if not parked:
+            del OUTBOX["parked"][chat_id]
+    outbox_queue().put_nowait(item)
+
+
+def outbox_release(chat_id: int) -> None:
+    for handle, item in OUTBOX["parked"].pop(chat_id, {}).values():
+        handle.cancel()
+        outbox_queue().put_nowait(item)
+
+
+def outbox_retry(item: tuple, delay: float) -> bool:
+    priority, seq, job = item
+    job["tries"] += 1
+    if job["tries"] > OUTBOX_MAX_RETRIES:
+        log.warning("Dropping %s to %s after %d tries", job["method"], job["chat_id"], job["tries"])
+        outbox_forget(job)
+        return False
+    loop = asyncio.get_running_loop()
+    chat_ready = OUTBOX["chat_ready"]
+    chat_ready[job["chat_id"]] = max(chat_ready.get(job["chat_id"], 0.0), loop.time() + delay)
+    # Same (priority, seq): the job keeps its place ahead of later messages for the chat.
+    outbox_queue().put_nowait(item)
+    return True
+
+
+async def outbox_send(bot, item: tuple) -> bool:
+    """Send one job; return True if it was put back in the queue."""
+    priority, seq, job = item
     try:
-        await context.bot.send_dice(chat_id=chat_id, emoji="🎰")
-        await asyncio.sleep(2.8)
+        await getattr(bot, job["method"])(chat_id=job["chat_id"], **job["kwargs"])
+    except RetryAfter as e:
+        wait = float(e.retry_after)
+        OUTBOX["paused_until"] = max(OUTBOX["paused_until"], asyncio.get_running_loop().time() + wait)
+        return outbox_retry(item, wait)
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return False
+        outbox_forget(job)
+        if job["fallback"]:
+            # Replace the job in place so the fallback keeps its seq (and its place
+            # before later messages for the chat), and release the hold it had.
+            job["method"], job["kwargs"] = job["fallback"]
+            job["fallback"], job["hold"] = None, 0.0
+            OUTBOX["chat_ready"][job["chat_id"]] = asyncio.get_running_loop().time()
+            outbox_queue().put_nowait(item)
+            outbox_release(job["chat_id"])
+            return True
+        log.warning("%s to %s rejected: %s", job["method"], job["chat_id"], e)
+    except NetworkError:
+        return outbox_retry(item, min(2.0 ** job["tries"], 30.0))
+    except TelegramError as e:
+        outbox_forget(job)
+        log.warning("%s to %s failed: %s", job["method"], job["chat_id"], e)
     except Exception:
-        msg = await context.bot.send_message(chat_id=chat_id, text="Spinning...")
-        for s in ["🎡", "🌀", "🎠", "✨", "🎡"]:
-            try:
-                await msg.edit_text(f"{s} Spinning...")
-            except Exception:
-                pass
-            await asyncio.sleep(0.25)
+        log.exception("%s to %s crashed", job["method"], job["chat_id"])
+    return False
+
+
+async def outbox_worker(bot) -> None:
+    q = outbox_queue()
+    loop = asyncio.get_running_loop()
+    chat_ready = OUTBOX["chat_ready"]
+    while True:
+        item = await q.get()
+        priority, seq, job = item
+        key = job["coalesce"]
+        if key is not None:
+            if OUTBOX["latest"].get(key) != seq:
+                outbox_forget(job)
+                continue  # superseded by a newer render for the same chat
+        chat_id = job["chat_id"]
+        now = loop.time()
+        ready = chat_ready.get(chat_id, 0.0)
+        if ready > now:
+            outbox_park(chat_id, item, ready - now)
+            continue
+
+        # Reserve the global slot and the chat before awaiting anything so the
+        # other workers see it immediately.
+        slot = max(now, OUTBOX["paused_until"], OUTBOX["next_slot"])
+        OUTBOX["next_slot"] = slot + 1.0 / OUTBOX_GLOBAL_RATE
+        chat_ready[chat_id] = slot + OUTBOX_CHAT_INTERVAL + job["hold"]
+        if len(chat_ready) > 10000:
+            for cid in [c for c, t in chat_ready.items() if t < now]:
+                del chat_ready[cid]
+        OUTBOX["busy"] += 1
+        try:
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            requeued = await outbox_send(bot, item)
+        finally:
+            OUTBOX["busy"] -= 1
+        # Only a finished job gives up its coalesce slot; a retried one must still
+        # count as the latest render unless a newer one arrived meanwhile.
+        if key is not None and not requeued and OUTBOX["latest"].get(key) == seq:
+            del OUTBOX["latest"][key]
+
+
+async def outbox_start(app: Application) -> None:
+    outbox_queue()
+    OUTBOX["tasks"] = [asyncio.create_task(outbox_worker(app.bot)) for _ in range(max(OUTBOX_WORKERS, 1))]
+
+
+async def outbox_stop(app: Application, timeout: float = 5.0) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while (not outbox_queue().empty() or OUTBOX["parked"] or OUTBOX["busy"]) and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    for t in OUTBOX["tasks"]:
+        t.cancel()
+    OUTBOX["tasks"] = []
+
+
+def send_spin_animation(chat_id: int) -> None:
+    enqueue(
+        "send_dice", chat_id, PRIO_RESULT,
+        # The animation needs ~2.8s; the chat's normal spacing already covers part of it.
+        hold=max(2.8 - OUTBOX_CHAT_INTERVAL, 0.0), fallback=("send_message", {"text": "🎡 Spinning..."}),
+        emoji="🎰",
+    )
 
 
 def is_admin(user_id: int) -> bool:
@@ -317,9 +685,9 @@ async def is_subscribed(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> boo
         return False
 
 
-async def get_bot_username(context: ContextTypes.DEFAULT_TYPE) -> str:
-    me = await context.bot.get_me()
-    return me.username or ""
+def get_bot_username(context: ContextTypes.DEFAULT_TYPE) -> str:
+    # Fetched once by Application.initialize(); no API call per press.
+    return context.bot.username or ""
 
 
 def main_menu_kb(user_id: int) -> InlineKeyboardMarkup:
@@ -329,7 +697,8 @@ def main_menu_kb(user_id: int) -> InlineKeyboardMarkup:
         [InlineKeyboardButton("🎡 Spin", callback_data="spin")],
         [InlineKeyboardButton("🎁 Gifts", callback_data="gifts"),
          InlineKeyboardButton("🛒 Buy Spins", callback_data="buy")],
-        [InlineKeyboardButton("🔗 Referral Link", callback_data="ref")],
+        [InlineKeyboardButton("🔗 Referral Link", callback_data="ref"),
+         InlineKeyboardButton("🏆 Top Referrers", callback_data="top")],
         [InlineKeyboardButton("💬 Contact", callback_data="contact")],
     ]
     if ch_url:
@@ -341,6 +710,13 @@ def main_menu_kb(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+def top_referrers_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Refresh", callback_data="top"),
+         InlineKeyboardButton("⬅️ Back", callback_data="back:menu")],
+    ])
+
+
 def admin_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📣 Set Required Channel", callback_data="admin:setchannel")],
@@ -349,8 +725,10 @@ def admin_menu_kb() -> InlineKeyboardMarkup:
          InlineKeyboardButton("🔗 Referral Bonus", callback_data="admin:setref")],
         [InlineKeyboardButton("💰 Paid Spin Cost", callback_data="admin:setcost")],
         [InlineKeyboardButton("❌ Lose Weight", callback_data="admin:setlose")],
-        [InlineKeyboardButton("🎁 Edit Gifts", callback_data="admin:gifts")],
+        [InlineKeyboardButton("🎁 Edit Gifts", callback_data="admin:gifts"),
+         InlineKeyboardButton("📦 Gift Stock", callback_data="admin:stock")],
         [InlineKeyboardButton("➕ Add Spins (User)", callback_data="admin:addspins")],
+        [InlineKeyboardButton("🧪 Simulate", callback_data="admin:simulate")],
         [InlineKeyboardButton("⬅️ Back", callback_data="back:menu")],
     ])
 
@@ -365,6 +743,16 @@ def admin_gifts_kb() -> InlineKeyboardMarkup:
     ])
 
 
+def admin_stock_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Gift 1", callback_data="admin:setstock:1"),
+         InlineKeyboardButton("Gift 2", callback_data="admin:setstock:2")],
+        [InlineKeyboardButton("Gift 3", callback_data="admin:setstock:3"),
+         InlineKeyboardButton("Gift 4", callback_data="admin:setstock:4")],
+        [InlineKeyboardButton("⬅️ Back", callback_data="admin:menu")],
+    ])
+
+
 def admin_addspins_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Add FREE spins", callback_data="admin:addfree")],
@@ -373,12 +761,7 @@ def admin_addspins_kb() -> InlineKeyboardMarkup:
     ])
 
 
-async def render_main(update: Update, context: ContextTypes.DEFAULT_TYPE, note: str = "") -> None:
-    u = update.effective_user
-    ensure_user(u)
-    refresh_daily_free(u.id)
-
-    user = get_user(u.id)
+def main_menu_text(user: dict, note: str = "") -> str:
     outcomes = load_outcomes()
     gifts = [o for o in outcomes if o["idx"] != 0]
 
@@ -393,7 +776,7 @@ async def render_main(update: Update, context: ContextTypes.DEFAULT_TYPE, note:
         lines.append(note)
     lines.append("")
     lines.append("👤 <b>Your account</b>")
-    lines.append(f"• ID: <code>{u.id}</code>")
+    lines.append(f"• ID: <code>{user['user_id']}</code>")
     lines.append(f"• Free spins today: <b>{user['free_spins']}</b>")
     lines.append(f"• Paid balance: <b>{user['paid_spins']}</b>")
     lines.append("")
@@ -406,11 +789,19 @@ async def render_main(update: Update, context: ContextTypes.DEFAULT_TYPE, note:
     lines.append(f"• Daily free spins: <b>{esc(daily)}</b>")
     lines.append(f"• Referral bonus: <b>{esc(ref_bonus)}</b>")
     lines.append(f"• Paid spin cost: <b>{esc(cost)}</b>")
+    return "\n".join(lines)
 
-    await update.effective_message.reply_text(
-        "\n".join(lines),
+
+async def render_main(update: Update, context: ContextTypes.DEFAULT_TYPE, note: str = "") -> None:
+    u = update.effective_user
+    ensure_user(u)
+    refresh_daily_free(u.id)
+
+    show_menu(
+        update,
+        main_menu_text(get_user(u.id), note),
+        main_menu_kb(u.id),
         parse_mode=ParseMode.HTML,
-        reply_markup=main_menu_kb(u.id),
         disable_web_page_preview=True,
     )
 
@@ -418,7 +809,7 @@ async def render_main(update: Update, context: ContextTypes.DEFAULT_TYPE, note:
 async def render_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     u = update.effective_user
     if not is_admin(u.id):
-        await update.effective_message.reply_text("❌ Admin panel is not available.")
+        reply(update, "❌ Admin panel is not available.")
         return
 
     outcomes = load_outcomes()
@@ -441,13 +832,24 @@ async def render_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "",
         "🎁 <b>Gifts</b>",
     ]
+    stock = load_stock()
     for g in gifts:
         lines.append(f"• {esc(g['name'])} | weight: <b>{g['weight']}</b> | {'OK' if g['sticker'] else 'MISSING'}")
+        row = stock.get(g["idx"])
+        if row and row["capacity"] is not None:
+            every = f" every {row['restock_days']}d" if row["restock_days"] > 0 else ""
+            lines.append(f"   stock: <b>{row['remaining']}</b>/{row['capacity']}{every}")
+    lines.append("")
+    lines.append(
+        f"🗄 User cache: <b>{len(USER_CACHE)}</b>/{USER_CACHE_SIZE} | "
+        f"hits <b>{USER_CACHE_STATS['hits']}</b> | misses <b>{USER_CACHE_STATS['misses']}</b>"
+    )
 
-    await update.effective_message.reply_text(
+    show_menu(
+        update,
         "\n".join(lines),
+        admin_menu_kb(),
         parse_mode=ParseMode.HTML,
-        reply_markup=admin_menu_kb(),
         disable_web_page_preview=True,
     )
 
@@ -463,6 +865,151 @@ def get_await(context: ContextTypes.DEFAULT_TYPE) -> Optional[dict]:
     return context.user_data.get("await")
 
 
+class StoragePersistence(BasePersistence):
+    """Keeps ``context.user_data`` (e.g. admin await-state) in STORE across restarts.
+
+    PTB hands over touched users every ``update_interval``; only entries whose
+    JSON differs from the last write are saved, as one batch per tick. Users idle
+    for longer than ``ttl`` are dropped from memory and storage by the evictor.
+    """
+
+    def __init__(self, ttl: float = USER_DATA_TTL, update_interval: float = PERSIST_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.ttl = ttl
+        self._saved: Dict[int, str] = {}            # user_id -> JSON last written
+        self._dirty: Dict[int, Optional[str]] = {}  # user_id -> JSON to write, None = delete
+        self._last_seen: Dict[int, float] = {}
+        self._flush_pending = False
+        self._evictor: Optional[asyncio.Task] = None
+
+    def _mark_dirty(self, user_id: int, blob: Optional[str]) -> None:
+        self._dirty[user_id] = blob
+        if not self._flush_pending:
+            # PTB runs all update_user_data calls of one tick together; writing
+            # once they are done turns the tick into a single transaction.
+            self._flush_pending = True
+            asyncio.get_running_loop().call_soon(self._write_dirty)
+
+    def _write_dirty(self) -> None:
+        self._flush_pending = False
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            STORE.save_user_data(batch, time.time())
+        except Exception:
+            log.exception("Saving user_data failed")
+            self._dirty = {**batch, **self._dirty}
+            return
+        for user_id, blob in batch.items():
+            if blob is None:
+                self._saved.pop(user_id, None)
+            else:
+                self._saved[user_id] = blob
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        now = time.time()
+        STORE.purge_user_data(now - self.ttl)
+        data = {}
+        for user_id, (blob, updated_at) in STORE.load_user_data(now - self.ttl).items():
+            data[user_id] = json.loads(blob)
+            self._saved[user_id] = blob
+            self._last_seen[user_id] = updated_at
+        return data
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._last_seen[user_id] = time.time()
+        blob = json.dumps(data, separators=(",", ":"), sort_keys=True) if data else None
+        if blob == self._saved.get(user_id) and user_id not in self._dirty:
+            return
+        if blob is None and user_id not in self._saved:
+            self._dirty.pop(user_id, None)
+            return
+        self._mark_dirty(user_id, blob)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self._last_seen[user_id] = time.time()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._last_seen.pop(user_id, None)
+        if user_id in self._saved or user_id in self._dirty:
+            self._mark_dirty(user_id, None)
+
+    async def flush(self) -> None:
+        self._write_dirty()
+
+    def start_evictor(self, app: Application) -> None:
+        self._evictor = asyncio.create_task(self._evict_loop(app))
+
+    def stop_evictor(self) -> None:
+        if self._evictor:
+            self._evictor.cancel()
+            self._evictor = None
+
+    async def _evict_loop(self, app: Application) -> None:
+        while True:
+            await asyncio.sleep(min(self.ttl / 4, 600))
+            self.evict_idle(app)
+
+    def evict_idle(self, app: Application) -> int:
+        cutoff = time.time() - self.ttl
+        seen = self._last_seen
+        idle = [uid for uid in app.user_data if seen.get(uid, 0) < cutoff]
+        for uid in idle:
+            app.drop_user_data(uid)
+            seen.pop(uid, None)
+        return len(idle)
+
+    # Only user_data is persisted; the rest are no-ops.
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+
+async def on_post_init(app: Application) -> None:
+    await outbox_start(app)
+    if isinstance(app.persistence, StoragePersistence):
+        app.persistence.start_evictor(app)
+
+
+async def on_post_stop(app: Application) -> None:
+    if isinstance(app.persistence, StoragePersistence):
+        app.persistence.stop_evictor()
+    await outbox_stop(app)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     u = update.effective_user
     ensure_user(u)
@@ -477,14 +1024,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 bonus = int(cfg_get("ref_bonus_spins") or "0")
                 if bonus > 0:
                     add_free_spins(ref, bonus)
-                    try:
-                        await context.bot.send_message(
-                            chat_id=ref,
-                            text=f"🎉 New referral! You received <b>{bonus}</b> free spin(s).",
-                            parse_mode=ParseMode.HTML,
-                        )
-                    except Exception:
-                        pass
+                    enqueue(
+                        "send_message", ref, PRIO_REFERRAL,
+                        text=f"🎉 New referral! You received <b>{bonus}</b> free spin(s).",
+                        parse_mode=ParseMode.HTML,
+                    )
 
     set_await(context, None)
     await render_main(update, context)
@@ -493,7 +1037,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     u = update.effective_user
     if not is_admin(u.id):
-        await update.effective_message.reply_text("❌ This command is for admins only.")
+        reply(update, "❌ This command is for admins only.")
         return
     await render_admin_menu(update, context)
 
@@ -521,11 +1065,12 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
     if data == "gifts":
-        gifts = [o for o in load_outcomes() if o["idx"] != 0]
+        gifts = [o for o in get_sampler()["outcomes"] if o["idx"] != 0]
         txt = ["🎁 <b>Roulette Gifts</b>", ""]
         for g in gifts:
-            txt.append(f"• {esc(g['name'])}")
-        await q.message.reply_text("\n".join(txt), parse_mode=ParseMode.HTML)
+            sold_out = " — <i>sold out</i>" if g["limited"] and g["remaining"] <= 0 else ""
+            txt.append(f"• {esc(g['name'])}{sold_out}")
+        reply(update, "\n".join(txt), parse_mode=ParseMode.HTML)
         return
 
     if data == "buy":
@@ -545,7 +1090,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             buttons = [[InlineKeyboardButton("💬 Contact to Buy", url=f"https://t.me/{contact[1:]}")]]
         elif contact.startswith("https://t.me/"):
             buttons = [[InlineKeyboardButton("💬 Contact to Buy", url=contact)]]
-        await q.message.reply_text(
+        reply(
+            update,
             text,
             parse_mode=ParseMode.HTML,
             reply_markup=InlineKeyboardMarkup(buttons) if buttons else None,
@@ -569,7 +1115,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             buttons = [[InlineKeyboardButton("💬 Open Chat", url=f"https://t.me/{contact[1:]}")]]
         elif contact.startswith("https://t.me/"):
             buttons = [[InlineKeyboardButton("💬 Open Chat", url=contact)]]
-        await q.message.reply_text(
+        reply(
+            update,
             text,
             parse_mode=ParseMode.HTML,
             reply_markup=InlineKeyboardMarkup(buttons) if buttons else None,
@@ -577,8 +1124,30 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         )
         return
 
+    if data == "top":
+        lines = ["🏆 <b>Top Referrers</b>", ""]
+        top = top_referrers(TOP_REFERRERS_N)
+        if not top:
+            lines.append("No referrals yet. Be the first!")
+        rank = 0
+        for i, r in enumerate(top, 1):
+            # Ties share a rank (1, 2, 2, 4), the same numbering referral_rank uses.
+            if i == 1 or r["referral_count"] != top[i - 2]["referral_count"]:
+                rank = i
+            name = r["first_name"] or (f"@{r['username']}" if r["username"] else str(r["user_id"]))
+            lines.append(f"{rank}. {esc(name)} — <b>{r['referral_count']}</b>")
+        lines.append("")
+        user = get_user(u.id)
+        rank = referral_rank(u.id)
+        if rank is None:
+            lines.append("You have no referrals yet. Share your 🔗 Referral Link!")
+        else:
+            lines.append(f"👤 Your rank: <b>#{rank}</b> ({user['referral_count']} referrals)")
+        show_menu(update, "\n".join(lines), top_referrers_kb(), parse_mode=ParseMode.HTML)
+        return
+
     if data == "ref":
-        bot_username = await get_bot_username(context)
+        bot_username = get_bot_username(context)
         ref_link = f"https://t.me/{bot_username}?start={u.id}"
         bonus = cfg_get("ref_bonus_spins").strip()
         txt = (
@@ -586,13 +1155,14 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             f"<code>{ref_link}</code>\n\n"
             f"Referrer bonus: <b>{esc(bonus)}</b> free spin(s)."
         )
-        await q.message.reply_text(txt, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+        reply(update, txt, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
         return
 
     if data == "spin":
         if not await is_subscribed(context, u.id):
             ch = cfg_get("required_channel").strip()
-            await q.message.reply_text(
+            reply(
+                update,
                 f"🚫 You must join the required channel first:\n<code>{esc(ch)}</code>",
                 parse_mode=ParseMode.HTML,
             )
@@ -600,7 +1170,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
         gifts = [o for o in load_outcomes() if o["idx"] != 0]
         if any(not g["sticker"] for g in gifts):
-            await q.message.reply_text(
+            reply(
+                update,
                 "⚠️ Some gifts are missing sticker file_id.\nAdmins must set them in the Admin Panel.",
                 parse_mode=ParseMode.HTML,
             )
@@ -616,7 +1187,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         elif paid_spins >= cost:
             used_type = "paid"
         else:
-            await q.message.reply_text(
+            reply(
+                update,
                 "🚫 Not enough spins.\n"
                 f"Free spins: <b>{free_spins}</b>\n"
                 f"Paid balance: <b>{paid_spins}</b>",
@@ -624,43 +1196,33 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             )
             return
 
-        outcomes = load_outcomes()
-        outcome = pick_weighted(outcomes)
-
-        con = db()
-        cur = con.cursor()
-        if used_type == "free":
-            cur.execute("UPDATE users SET free_spins = free_spins - 1 WHERE user_id=?", (u.id,))
-        else:
-            cur.execute("UPDATE users SET paid_spins = paid_spins - ? WHERE user_id=?", (cost, u.id))
-        cur.execute(
-            "INSERT INTO spins(user_id, used_type, result_idx, result_name, result_sticker, created_at) VALUES(?,?,?,?,?,?)",
-            (u.id, used_type, outcome["idx"], outcome["name"], outcome["sticker"] or "", datetime.utcnow().isoformat()),
-        )
-        con.commit()
-        con.close()
+        outcome = commit_spin(u.id, used_type, cost, sample(get_sampler()))
+        if outcome is None:
+            reply(update, "🚫 Not enough spins.", parse_mode=ParseMode.HTML)
+            return
 
-        await send_spin_animation(chat_id=u.id, context=context)
+        send_spin_animation(chat_id=u.id)
 
         if outcome["sticker"]:
-            try:
-                await context.bot.send_sticker(chat_id=u.id, sticker=outcome["sticker"])
-            except Exception:
-                pass
-            await q.message.reply_text(
+            enqueue("send_sticker", u.id, PRIO_RESULT, sticker=outcome["sticker"])
+            reply(
+                update,
                 f"🎉 <b>You won!</b>\nGift: <b>{esc(outcome['name'])}</b>\nSpin type: <code>{used_type}</code>",
+                PRIO_RESULT,
                 parse_mode=ParseMode.HTML,
             )
         else:
-            await q.message.reply_text(
+            reply(
+                update,
                 f"🍀 <b>Better luck next time!</b>\n{esc(outcome['name'])}\nSpin type: <code>{used_type}</code>",
+                PRIO_RESULT,
                 parse_mode=ParseMode.HTML,
             )
         return
 
     if data.startswith("admin:"):
         if not is_admin(u.id):
-            await q.message.reply_text("❌ Not allowed.")
+            reply(update, "❌ Not allowed.")
             return
 
         if data == "admin:menu":
@@ -670,12 +1232,13 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
         if data == "admin:setchannel":
             set_await(context, {"type": "setchannel"})
-            await q.message.reply_text("📣 Send channel username starting with @ (example: @MyChannel)", parse_mode=ParseMode.HTML)
+            reply(update, "📣 Send channel username starting with @ (example: @MyChannel)", parse_mode=ParseMode.HTML)
             return
 
         if data == "admin:setcontact":
             set_await(context, {"type": "setcontact"})
-            await q.message.reply_text(
+            reply(
+                update,
                 "💬 Send the contact username (example: @YourSupport)\n"
                 "Or a full link: https://t.me/YourSupport",
                 parse_mode=ParseMode.HTML,
@@ -684,27 +1247,27 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
         if data == "admin:setdaily":
             set_await(context, {"type": "setdaily"})
-            await q.message.reply_text("🗓 Send daily free spins (example: 3)", parse_mode=ParseMode.HTML)
+            reply(update, "🗓 Send daily free spins (example: 3)", parse_mode=ParseMode.HTML)
             return
 
         if data == "admin:setref":
             set_await(context, {"type": "setref"})
-            await q.message.reply_text("🔗 Send referral bonus spins (example: 2)", parse_mode=ParseMode.HTML)
+            reply(update, "🔗 Send referral bonus spins (example: 2)", parse_mode=ParseMode.HTML)
             return
 
         if data == "admin:setcost":
             set_await(context, {"type": "setcost"})
-            await q.message.reply_text("💰 Send paid spin cost (example: 1)", parse_mode=ParseMode.HTML)
+            reply(update, "💰 Send paid spin cost (example: 1)", parse_mode=ParseMode.HTML)
             return
 
         if data == "admin:setlose":
             set_await(context, {"type": "setlose"})
-            await q.message.reply_text("❌ Send lose weight (example: 999996)", parse_mode=ParseMode.HTML)
+            reply(update, "❌ Send lose weight (example: 999996)", parse_mode=ParseMode.HTML)
             return
 
         if data == "admin:gifts":
             set_await(context, None)
-            await q.message.reply_text("🎁 Choose a gift to edit:", reply_markup=admin_gifts_kb())
+            show_menu(update, "🎁 Choose a gift to edit:", admin_gifts_kb())
             return
 
         if data.startswith("admin:setgift:"):
@@ -715,7 +1278,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             except Exception:
                 return
             set_await(context, {"type": "setgift", "idx": idx})
-            await q.message.reply_text(
+            reply(
+                update,
                 f"🎁 Edit Gift {idx}\n"
                 "Send 3 lines:\n<code>Name</code>\n<code>Weight</code>\n<code>sticker_file_id</code>\n"
                 "Or one line separated by |",
@@ -723,19 +1287,55 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             )
             return
 
+        if data == "admin:stock":
+            set_await(context, None)
+            show_menu(update, "📦 Choose a gift to set its stock:", admin_stock_kb())
+            return
+
+        if data.startswith("admin:setstock:"):
+            try:
+                idx = int(data.split(":")[-1])
+                if idx not in (1, 2, 3, 4):
+                    raise ValueError()
+            except Exception:
+                return
+            set_await(context, {"type": "setstock", "idx": idx})
+            reply(
+                update,
+                f"📦 Stock for Gift {idx}\n"
+                "Send: <code>amount restock_days</code> (example: <code>10 7</code>)\n"
+                "restock_days 0 = never refill. Send <code>off</code> for unlimited.",
+                parse_mode=ParseMode.HTML,
+            )
+            return
+
         if data == "admin:addspins":
             set_await(context, None)
-            await q.message.reply_text("➕ Choose:", reply_markup=admin_addspins_kb())
+            show_menu(update, "➕ Choose:", admin_addspins_kb())
+            return
+
+        if data == "admin:simulate":
+            cost = int(cfg_get("spin_cost_paid") or "1")
+            try:
+                report = await asyncio.to_thread(simulate_outcomes, load_outcomes())
+            except Exception as e:
+                reply(update, f"❌ Simulation failed: {esc(str(e))}", parse_mode=ParseMode.HTML)
+                return
+            reply(
+                update,
+                "🧪 <b>Odds Simulation</b>\n<pre>" + esc(format_sim_report(report, cost)) + "</pre>",
+                parse_mode=ParseMode.HTML,
+            )
             return
 
         if data == "admin:addfree":
             set_await(context, {"type": "addfree"})
-            await q.message.reply_text("➕ Send: user_id amount   Example: 123456 5", parse_mode=ParseMode.HTML)
+            reply(update, "➕ Send: user_id amount   Example: 123456 5", parse_mode=ParseMode.HTML)
             return
 
         if data == "admin:addpaid":
             set_await(context, {"type": "addpaid"})
-            await q.message.reply_text("➕ Send: user_id amount   Example: 123456 5", parse_mode=ParseMode.HTML)
+            reply(update, "➕ Send: user_id amount   Example: 123456 5", parse_mode=ParseMode.HTML)
             return
 
 
@@ -748,12 +1348,12 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     if not is_admin(u.id):
         set_await(context, None)
-        await update.effective_message.reply_text("❌ Not allowed.")
+        reply(update, "❌ Not allowed.")
         return
 
     if txt.lower() in ("cancel", "إلغاء", "الغاء"):
         set_await(context, None)
-        await update.effective_message.reply_text("✅ Cancelled.")
+        reply(update, "✅ Cancelled.")
         return
 
     t = state.get("type")
@@ -763,7 +1363,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 raise ValueError("Must start with @")
             cfg_set("required_channel", txt)
             set_await(context, None)
-            await update.effective_message.reply_text(f"✅ Required channel set to: {txt}")
+            reply(update, f"✅ Required channel set to: {txt}")
             return
 
         if t == "setcontact":
@@ -771,7 +1371,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 raise ValueError("Send @Username or https://t.me/Username")
             cfg_set("contact_username", txt)
             set_await(context, None)
-            await update.effective_message.reply_text(f"✅ Contact username set to: {txt}")
+            reply(update, f"✅ Contact username set to: {txt}")
             return
 
         if t == "setdaily":
@@ -780,7 +1380,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 raise ValueError("Invalid number")
             cfg_set("daily_free_spins", str(n))
             set_await(context, None)
-            await update.effective_message.reply_text(f"✅ Daily free spins = {n}")
+            reply(update, f"✅ Daily free spins = {n}")
             return
 
         if t == "setref":
@@ -789,7 +1389,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 raise ValueError("Invalid number")
             cfg_set("ref_bonus_spins", str(n))
             set_await(context, None)
-            await update.effective_message.reply_text(f"✅ Referral bonus = {n}")
+            reply(update, f"✅ Referral bonus = {n}")
             return
 
         if t == "setcost":
@@ -798,7 +1398,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 raise ValueError("Invalid number")
             cfg_set("spin_cost_paid", str(n))
             set_await(context, None)
-            await update.effective_message.reply_text(f"✅ Paid spin cost = {n}")
+            reply(update, f"✅ Paid spin cost = {n}")
             return
 
         if t == "setlose":
@@ -807,7 +1407,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 raise ValueError("Invalid number")
             cfg_set("lose_weight", str(n))
             set_await(context, None)
-            await update.effective_message.reply_text(f"✅ Lose weight = {n}")
+            reply(update, f"✅ Lose weight = {n}")
             return
 
         if t == "setgift":
@@ -825,7 +1425,27 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             cfg_set(f"gift{idx}_weight", str(weight))
             cfg_set(f"gift{idx}_sticker", sticker)
             set_await(context, None)
-            await update.effective_message.reply_text(f"✅ Gift {idx} updated: {name}")
+            reply(update, f"✅ Gift {idx} updated: {name}")
+            return
+
+        if t == "setstock":
+            idx = int(state["idx"])
+            if txt.lower() == "off":
+                set_gift_stock(idx, None)
+                set_await(context, None)
+                reply(update, f"✅ Gift {idx} stock: unlimited")
+                return
+            parts = txt.split()
+            if len(parts) not in (1, 2):
+                raise ValueError("Format: amount restock_days")
+            amount = int(parts[0])
+            days = int(parts[1]) if len(parts) == 2 else 0
+            if amount < 0 or days < 0:
+                raise ValueError("Numbers must be >= 0")
+            set_gift_stock(idx, amount, days)
+            set_await(context, None)
+            every = f", refilled every {days} day(s)" if days else ""
+            reply(update, f"✅ Gift {idx} stock: {amount}{every}")
             return
 
         if t in ("addfree", "addpaid"):
@@ -844,11 +1464,12 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 add_paid_spins(uid, amt)
                 msg = f"✅ Added {amt} PAID balance to user {uid}"
             set_await(context, None)
-            await update.effective_message.reply_text(msg)
+            reply(update, msg)
             return
 
     except Exception as e:
-        await update.effective_message.reply_text(
+        reply(
+            update,
             f"❌ Error: {esc(str(e))}\nType <code>cancel</code> to cancel.",
             parse_mode=ParseMode.HTML,
         )
@@ -860,7 +1481,14 @@ def main() -> None:
 
     init_db()
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .persistence(StoragePersistence())
+        .post_init(on_post_init)
+        .post_stop(on_post_stop)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("admin", cmd_admin))
     app.add_handler(CallbackQueryHandler(on_callback))
@@ -870,5 +1498,19 @@ def main() -> None:
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
+def cli_simulate(argv: List[str]) -> None:
+    p = argparse.ArgumentParser(prog="bot.py simulate", description="Monte Carlo odds report for the current weights.")
+    p.add_argument("--draws", type=int, default=SIM_DRAWS)
+    p.add_argument("--seed", type=int, default=None)
+    args = p.parse_args(argv)
+
+    init_db()
+    report = simulate_outcomes(load_outcomes(), args.draws, args.seed)
+    print(format_sim_report(report, int(cfg_get("spin_cost_paid") or "1")))
+
+
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ["simulate"]:
+        cli_simulate(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Self-checks for the bot's concurrency-sensitive parts. They need no network
+and no bot token.
+
+    python check.py outbox                 # outbox against a fake bot
+    python check.py stress-stock [--spinners N] [--stock N] [--backend memory]
+
+outbox runs the outbound queue against a fake Telegram bot and checks
+retries, the dice fallback, coalescing, priority order, and global and
+per-chat spacing. stress-stock has many threads spin at once against one
+limited gift on a temporary database; stock must never oversell. Both exit 1
+on failure.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from datetime import datetime, date
+from types import SimpleNamespace
+from typing import Awaitable, Callable, List, Tuple
+
+from telegram.error import BadRequest, RetryAfter
+
+import bot
+from storage import open_storage
+
+
+class FakeBot:
+    """Stands in for telegram.Bot: records every send, fails on cue."""
+
+    def __init__(self):
+        self.sent: List[Tuple[float, int, str, str]] = []  # (time, chat_id, method, text)
+        self.retry_once = set()
+
+    async def _call(self, method: str, chat_id: int, **kwargs) -> None:
+        text = kwargs.get("text", kwargs.get("emoji", kwargs.get("sticker")))
+        await asyncio.sleep(0.01)  # round trip, lets other workers pick up the chat's next job
+        if method == "send_dice":
+            raise BadRequest("Dice not allowed here")
+        if text in self.retry_once:
+            self.retry_once.discard(text)
+            raise RetryAfter(1)
+        self.sent.append((asyncio.get_running_loop().time(), chat_id, method, text))
+
+    async def send_message(self, chat_id: int, **kwargs) -> None:
+        await self._call("send_message", chat_id, **kwargs)
+
+    async def edit_message_text(self, chat_id: int, **kwargs) -> None:
+        await self._call("edit_message_text", chat_id, **kwargs)
+
+    async def send_dice(self, chat_id: int, **kwargs) -> None:
+        await self._call("send_dice", chat_id, **kwargs)
+
+    async def send_sticker(self, chat_id: int, **kwargs) -> None:
+        await self._call("send_sticker", chat_id, **kwargs)
+
+    def texts(self, chat_id: int = None) -> List[str]:
+        return [t for _, c, _, t in self.sent if chat_id is None or c == chat_id]
+
+    def times(self, chat_id: int = None) -> List[float]:
+        return [at for at, c, _, _ in self.sent if chat_id is None or c == chat_id]
+
+
+async def run_outbox(fake: FakeBot, fill: Callable[[], None]) -> None:
+    """Queue jobs with ``fill`` on an idle outbox, then let it drain."""
+    bot.OUTBOX.update(next_slot=0.0, paused_until=0.0, chat_ready={}, latest={}, parked={})
+    app = SimpleNamespace(bot=fake)
+    fill()  # before the workers start, so priority alone decides the order
+    await bot.outbox_start(app)
+    await bot.outbox_stop(app, timeout=10.0)
+
+
+def expect(ok: bool, what: str) -> None:
+    if not ok:
+        raise AssertionError(what)
+
+
+async def check_retry(interval: float) -> None:
+    fake = FakeBot()
+    fake.retry_once.update({"retry menu", "retry edit"})
+    await run_outbox(fake, lambda: (
+        bot.enqueue("send_message", 1, bot.PRIO_MENU, coalesce="menu", text="retry menu"),
+        bot.enqueue("edit_message_text", 2, bot.PRIO_MENU, coalesce="menu", message_id=1, text="retry edit"),
+    ))
+    expect(fake.texts(1) == ["retry menu"], f"coalesced send lost after RetryAfter: {fake.texts()}")
+    expect(fake.texts(2) == ["retry edit"], f"coalesced edit lost after RetryAfter: {fake.texts()}")
+    expect(not bot.OUTBOX["latest"], f"coalesce keys left behind: {bot.OUTBOX['latest']}")
+
+
+async def check_fallback(interval: float) -> None:
+    fake = FakeBot()
+    await run_outbox(fake, lambda: (
+        bot.send_spin_animation(3),
+        bot.enqueue("send_message", 3, bot.PRIO_RESULT, text="result"),
+    ))
+    expect(fake.texts(3) == ["🎡 Spinning...", "result"], f"dice fallback out of order: {fake.texts(3)}")
+    gap = fake.times(3)[1] - fake.times(3)[0]
+    expect(gap < interval + 0.5, f"chat still held {gap:.2f}s for a dice that was never sent")
+
+
+async def check_coalesce(interval: float) -> None:
+    fake = FakeBot()
+    await run_outbox(fake, lambda: [
+        bot.enqueue("send_message", 4, bot.PRIO_MENU, coalesce="menu", text=f"menu {i}") for i in range(1, 4)
+    ])
+    expect(fake.texts(4) == ["menu 3"], f"only the newest render should be sent: {fake.texts(4)}")
+
+    # In-place menu edits only supersede edits of the same message.
+    fake = FakeBot()
+
+    def press(message_id: int, text: str) -> None:
+        msg = SimpleNamespace(chat_id=5, message_id=message_id, text="old", text_html="old", reply_markup=None)
+        bot.show_menu(SimpleNamespace(callback_query=SimpleNamespace(message=msg)), text)
+
+    await run_outbox(fake, lambda: (press(1, "A old"), press(2, "B"), press(1, "A new")))
+    expect(sorted(fake.texts(5)) == ["A new", "B"], f"edits of different messages collided: {fake.texts(5)}")
+
+
+async def check_priority(interval: float) -> None:
+    fake = FakeBot()
+    await run_outbox(fake, lambda: (
+        bot.enqueue("send_message", 10, bot.PRIO_BROADCAST, text="broadcast"),
+        bot.enqueue("send_message", 11, bot.PRIO_REFERRAL, text="referral"),
+        bot.enqueue("send_message", 12, bot.PRIO_MENU, text="menu"),
+        bot.enqueue("send_message", 13, bot.PRIO_RESULT, text="result"),
+    ))
+    order = ["result", "menu", "referral", "broadcast"]
+    expect(fake.texts() == order, f"sent {fake.texts()}, want {order}")
+
+
+async def check_spacing(interval: float) -> None:
+    fake = FakeBot()
+    await run_outbox(fake, lambda: [
+        bot.enqueue("send_message", 20 + i % 2, bot.PRIO_RESULT, text=f"msg {i}") for i in range(6)
+    ])
+    step = 1.0 / bot.OUTBOX_GLOBAL_RATE
+    times = fake.times()
+    expect(len(times) == 6, f"lost messages: {fake.texts()}")
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    expect(min(gaps) >= step * 0.9, f"global rate exceeded: gaps {gaps}")
+    for chat_id in (20, 21):
+        chat = fake.times(chat_id)
+        gaps = [b - a for a, b in zip(chat, chat[1:])]
+        expect(min(gaps) >= interval * 0.9, f"chat {chat_id} spacing below {interval}s: gaps {gaps}")
+
+
+OUTBOX_CHECKS: List[Tuple[str, Callable[[float], Awaitable[None]]]] = [
+    ("retry", check_retry),
+    ("fallback", check_fallback),
+    ("coalesce", check_coalesce),
+    ("priority", check_priority),
+    ("spacing", check_spacing),
+]
+
+
+def cmd_outbox(argv: List[str]) -> int:
+    p = argparse.ArgumentParser(prog="check.py outbox", description="Outbox checks against a fake bot.")
+    p.add_argument("--interval", type=float, default=0.2, help="per-chat spacing to use")
+    args = p.parse_args(argv)
+    bot.OUTBOX_CHAT_INTERVAL = args.interval
+
+    async def run() -> int:
+        for name, check in OUTBOX_CHECKS:
+            try:
+                await check(args.interval)
+            except AssertionError as e:
+                print(f"{name:<10} FAIL  {e}")
+                return 1
+            print(f"{name:<10} ok")
+        return 0
+
+    return asyncio.run(run())
+
+
+def cmd_stress_stock(argv: List[str]) -> int:
+    p = argparse.ArgumentParser(prog="check.py stress-stock", description="Concurrent spin stress test for gift stock.")
+    p.add_argument("--spinners", type=int, default=64)
+    p.add_argument("--spins", type=int, default=20, help="spins per spinner")
+    p.add_argument("--stock", type=int, default=10)
+    p.add_argument("--backend", default=bot.STORAGE_BACKEND)
+    args = p.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = bot.STORE = open_storage(args.backend, os.path.join(tmp, "stress.db"))
+        bot.init_db()
+        bot.cfg_set("lose_weight", "1")
+        bot.cfg_set("gift4_weight", "1000000")
+        bot.set_gift_stock(4, args.stock)
+
+        uids = range(1, args.spinners + 1)
+        for uid in uids:
+            store.ensure_user(uid, "", "", datetime.utcnow().isoformat())
+            store.reset_daily_free(uid, args.spins, date.today().isoformat())
+
+        barrier = threading.Barrier(args.spinners)
+        errors = []
+
+        def spinner(uid: int) -> None:
+            try:
+                barrier.wait()
+                for _ in range(args.spins):
+                    bot.commit_spin(uid, "free", 1, bot.sample(bot.get_sampler()))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=spinner, args=(uid,)) for uid in uids]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        counts = store.spin_counts()
+        won, total = counts.get(4, 0), sum(counts.values())
+        remaining = store.load_stock()[4]["remaining"]
+        negative = sum(1 for uid in uids if store.get_user(uid)["free_spins"] < 0)
+        store.close()
+
+    print(f"{total} spins by {args.spinners} spinners in {elapsed:.2f}s")
+    print(f"gift 4 won {won} times, stock {args.stock}, remaining {remaining}")
+    ok = not errors and won == args.stock and remaining == 0 and negative == 0 \
+        and total == args.spinners * args.spins
+    if errors:
+        print(f"errors: {errors[:3]}")
+    if not ok:
+        print("FAIL")
+        return 1
+    print("OK")
+    return 0
+
+
+COMMANDS = {
+    "outbox": cmd_outbox,
+    "stress-stock": cmd_stress_stock,
+}
+
+
+def main(argv: List[str]) -> int:
+    if not argv or argv[0] not in COMMANDS:
+        print(f"usage: check.py {{{','.join(COMMANDS)}}} [options]")
+        return 2
+    return COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,584 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends for Gift Roulette Bot.
+
+Everything the bot persists (config, users and their balances, spins,
+referrals, gift stock, per-user bot state) goes through a Storage object.
+Two backends:
+
+- sqlite: the real thing, one file, WAL mode, one connection per thread
+- memory: plain dicts behind a lock, for benchmarks and throwaway runs
+
+Pick one with open_storage("sqlite" | "memory", path).
+"""
+
+import heapq
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set, Tuple
+
+
+class Storage(ABC):
+    """Interface used by the bot. Rows are returned as plain dicts."""
+
+    @abstractmethod
+    def init(self, config_defaults: Dict[str, str], gift_count: int) -> None:
+        """Create/migrate the schema and insert missing config defaults."""
+
+    def close(self) -> None:
+        pass
+
+    # config
+    @abstractmethod
+    def config_all(self) -> Dict[str, str]:
+        ...
+
+    @abstractmethod
+    def config_set(self, key: str, value: str) -> None:
+        ...
+
+    # users and balances
+    @abstractmethod
+    def ensure_user(self, user_id: int, username: str, first_name: str, now: str) -> dict:
+        """Insert the user if missing, refresh the names and return the row."""
+
+    @abstractmethod
+    def get_user(self, user_id: int) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def add_spins(self, user_id: int, free: int = 0, paid: int = 0) -> None:
+        ...
+
+    @abstractmethod
+    def reset_daily_free(self, user_id: int, amount: int, today: str) -> None:
+        ...
+
+    # referrals
+    @abstractmethod
+    def set_referrer_if_empty(self, user_id: int, referrer_id: int) -> bool:
+        """Set the referrer once and bump the referrer's referral_count with it."""
+
+    @abstractmethod
+    def top_referrers(self, limit: int) -> List[dict]:
+        """Users with the most referrals, ties broken by user_id."""
+
+    @abstractmethod
+    def referral_rank(self, user_id: int) -> Optional[int]:
+        """1-based rank by referral_count (ties share a rank); None without referrals."""
+
+    # gift stock
+    @abstractmethod
+    def load_stock(self) -> Dict[int, dict]:
+        ...
+
+    @abstractmethod
+    def set_gift_stock(self, idx: int, capacity: Optional[int], restock_days: int, now: str) -> None:
+        ...
+
+    @abstractmethod
+    def restock(self, idx: int, last_restocked_at: Optional[str], now: str) -> bool:
+        """Refill gift ``idx`` unless someone else already did since ``last_restocked_at``."""
+
+    # spins
+    @abstractmethod
+    def commit_spin(self, user_id: int, used_type: str, cost: int, outcome: Dict, lose: Dict,
+                    now: str) -> Optional[Tuple[Dict, bool]]:
+        """Debit the spin, take a limited gift from stock and record the spin atomically.
+
+        Returns ``(awarded_outcome, sold_out)`` or None if the balance is short.
+        ``awarded_outcome`` is ``lose`` when the gift had no stock left.
+        """
+
+    @abstractmethod
+    def spin_counts(self) -> Dict[int, int]:
+        """Number of recorded spins per result idx."""
+
+    # per-user bot state (PTB user_data), stored as compact JSON
+    @abstractmethod
+    def load_user_data(self, since: float) -> Dict[int, Tuple[str, float]]:
+        """Return ``{user_id: (json, updated_at)}`` for entries touched at or after ``since``."""
+
+    @abstractmethod
+    def save_user_data(self, batch: Dict[int, Optional[str]], now: float) -> None:
+        """Write a batch of entries; ``None`` deletes the entry."""
+
+    @abstractmethod
+    def purge_user_data(self, before: float) -> int:
+        """Delete entries not touched since ``before``; return how many."""
+
+
+def table_columns(con: sqlite3.Connection, table: str) -> set:
+    cur = con.cursor()
+    cur.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cur.fetchall()}
+
+
+def ensure_column(con: sqlite3.Connection, table: str, col: str, col_type: str, default_sql: str = "") -> None:
+    if col in table_columns(con, table):
+        return
+    cur = con.cursor()
+    sql = f"ALTER TABLE {table} ADD COLUMN {col} {col_type}"
+    if default_sql:
+        sql += f" DEFAULT {default_sql}"
+    cur.execute(sql)
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _con(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            # Autocommit; multi-statement writes use explicit BEGIN IMMEDIATE.
+            con = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            con.row_factory = sqlite3.Row
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute("PRAGMA temp_store=MEMORY")
+            con.execute("PRAGMA cache_size=-16000")
+            self._local.con = con
+        return con
+
+    @contextmanager
+    def _tx(self):
+        con = self._con()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            yield con.cursor()
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+
+    def close(self) -> None:
+        con = getattr(self._local, "con", None)
+        if con is not None:
+            con.close()
+            self._local.con = None
+
+    def init(self, config_defaults: Dict[str, str], gift_count: int) -> None:
+        con = self._con()
+        cur = con.cursor()
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS config(
+          key TEXT PRIMARY KEY,
+          value TEXT NOT NULL
+        )
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users(
+          user_id INTEGER PRIMARY KEY,
+          username TEXT,
+          first_name TEXT,
+          referrer_id INTEGER,
+          free_spins INTEGER NOT NULL DEFAULT 0,
+          paid_spins INTEGER NOT NULL DEFAULT 0,
+          last_free_date TEXT,
+          created_at TEXT NOT NULL,
+          referral_count INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS spins(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          user_id INTEGER NOT NULL,
+          used_type TEXT NOT NULL,
+          result_idx INTEGER NOT NULL,
+          result_name TEXT NOT NULL,
+          result_sticker TEXT,
+          created_at TEXT NOT NULL
+        )
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS gift_stock(
+          idx INTEGER PRIMARY KEY,
+          capacity INTEGER,
+          remaining INTEGER NOT NULL DEFAULT 0,
+          restock_days INTEGER NOT NULL DEFAULT 0,
+          restocked_at TEXT
+        )
+        """)
+        for i in range(1, gift_count + 1):
+            # capacity NULL = unlimited supply
+            cur.execute("INSERT OR IGNORE INTO gift_stock(idx) VALUES(?)", (i,))
+
+        # Auto-migrate
+        ensure_column(con, "users", "username", "TEXT")
+        ensure_column(con, "users", "first_name", "TEXT")
+        ensure_column(con, "users", "referrer_id", "INTEGER")
+        ensure_column(con, "users", "free_spins", "INTEGER", "0")
+        ensure_column(con, "users", "paid_spins", "INTEGER", "0")
+        ensure_column(con, "users", "last_free_date", "TEXT")
+        ensure_column(con, "users", "created_at", "TEXT")
+        if "referral_count" not in table_columns(con, "users"):
+            ensure_column(con, "users", "referral_count", "INTEGER NOT NULL", "0")
+            cur.execute("SELECT referrer_id, COUNT(*) FROM users WHERE referrer_id IS NOT NULL GROUP BY referrer_id")
+            cur.executemany("UPDATE users SET referral_count=? WHERE user_id=?", [(n, rid) for rid, n in cur.fetchall()])
+            cur.execute("DROP TABLE IF EXISTS referral_counts")
+        # Only referrers are indexed; the leaderboard never looks at zeros.
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_referral_count "
+            "ON users(referral_count DESC, user_id) WHERE referral_count > 0"
+        )
+        # How many users have each referral_count, so a rank is a short PK range sum
+        # instead of counting every referrer ahead.
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='referral_counts'")
+        if not cur.fetchone():
+            cur.execute("""
+            CREATE TABLE referral_counts(
+              referral_count INTEGER PRIMARY KEY,
+              users INTEGER NOT NULL
+            )
+            """)
+            cur.execute("""
+            INSERT INTO referral_counts(referral_count, users)
+            SELECT referral_count, COUNT(*) FROM users WHERE referral_count > 0 GROUP BY referral_count
+            """)
+
+        ensure_column(con, "spins", "used_type", "TEXT")
+        ensure_column(con, "spins", "result_idx", "INTEGER")
+        ensure_column(con, "spins", "result_name", "TEXT")
+        ensure_column(con, "spins", "result_sticker", "TEXT")
+        ensure_column(con, "spins", "created_at", "TEXT")
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_data(
+          user_id INTEGER PRIMARY KEY,
+          data TEXT NOT NULL,
+          updated_at REAL NOT NULL
+        )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_user_data_updated ON user_data(updated_at)")
+
+        for k, v in config_defaults.items():
+            cur.execute("INSERT OR IGNORE INTO config(key,value) VALUES(?,?)", (k, v))
+
+    def config_all(self) -> Dict[str, str]:
+        cur = self._con().execute("SELECT key, value FROM config")
+        return {r["key"]: r["value"] for r in cur.fetchall()}
+
+    def config_set(self, key: str, value: str) -> None:
+        self._con().execute(
+            "INSERT INTO config(key,value) VALUES(?,?) "
+            "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            (key, value),
+        )
+
+    def ensure_user(self, user_id: int, username: str, first_name: str, now: str) -> dict:
+        with self._tx() as cur:
+            cur.execute(
+                "INSERT OR IGNORE INTO users(user_id, username, first_name, created_at) VALUES(?,?,?,?)",
+                (user_id, username, first_name, now),
+            )
+            cur.execute("UPDATE users SET username=?, first_name=? WHERE user_id=?", (username, first_name, user_id))
+            cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
+            return dict(cur.fetchone())
+
+    def get_user(self, user_id: int) -> Optional[dict]:
+        r = self._con().execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
+        return dict(r) if r else None
+
+    def add_spins(self, user_id: int, free: int = 0, paid: int = 0) -> None:
+        self._con().execute(
+            "UPDATE users SET free_spins = free_spins + ?, paid_spins = paid_spins + ? WHERE user_id=?",
+            (free, paid, user_id),
+        )
+
+    def reset_daily_free(self, user_id: int, amount: int, today: str) -> None:
+        self._con().execute(
+            "UPDATE users SET free_spins=?, last_free_date=? WHERE user_id=?",
+            (amount, today, user_id),
+        )
+
+    def set_referrer_if_empty(self, user_id: int, referrer_id: int) -> bool:
+        with self._tx() as cur:
+            cur.execute(
+                "UPDATE users SET referrer_id=? WHERE user_id=? AND referrer_id IS NULL",
+                (referrer_id, user_id),
+            )
+            if cur.rowcount != 1:
+                return False
+            cur.execute("SELECT referral_count FROM users WHERE user_id=?", (referrer_id,))
+            r = cur.fetchone()
+            if r is None:
+                return True
+            old = r["referral_count"]
+            cur.execute("UPDATE users SET referral_count = ? WHERE user_id=?", (old + 1, referrer_id))
+            if old > 0:
+                cur.execute("UPDATE referral_counts SET users = users - 1 WHERE referral_count=?", (old,))
+            cur.execute(
+                "INSERT INTO referral_counts(referral_count, users) VALUES(?, 1) "
+                "ON CONFLICT(referral_count) DO UPDATE SET users = users + 1",
+                (old + 1,),
+            )
+        return True
+
+    def top_referrers(self, limit: int) -> List[dict]:
+        cur = self._con().execute(
+            "SELECT user_id, username, first_name, referral_count FROM users "
+            "WHERE referral_count > 0 ORDER BY referral_count DESC, user_id LIMIT ?",
+            (limit,),
+        )
+        return [dict(r) for r in cur.fetchall()]
+
+    def referral_rank(self, user_id: int) -> Optional[int]:
+        con = self._con()
+        r = con.execute("SELECT referral_count FROM users WHERE user_id=?", (user_id,)).fetchone()
+        if not r or r["referral_count"] <= 0:
+            return None
+        ahead = con.execute(
+            "SELECT COALESCE(SUM(users), 0) FROM referral_counts WHERE referral_count > ?",
+            (r["referral_count"],),
+        ).fetchone()[0]
+        return ahead + 1
+
+    def load_stock(self) -> Dict[int, dict]:
+        cur = self._con().execute("SELECT * FROM gift_stock")
+        return {r["idx"]: dict(r) for r in cur.fetchall()}
+
+    def set_gift_stock(self, idx: int, capacity: Optional[int], restock_days: int, now: str) -> None:
+        self._con().execute(
+            "UPDATE gift_stock SET capacity=?, remaining=?, restock_days=?, restocked_at=? WHERE idx=?",
+            (capacity, capacity or 0, restock_days, now, idx),
+        )
+
+    def restock(self, idx: int, last_restocked_at: Optional[str], now: str) -> bool:
+        cur = self._con().execute(
+            "UPDATE gift_stock SET remaining=capacity, restocked_at=? WHERE idx=? AND restocked_at IS ?",
+            (now, idx, last_restocked_at),
+        )
+        return cur.rowcount == 1
+
+    def commit_spin(self, user_id: int, used_type: str, cost: int, outcome: Dict, lose: Dict,
+                    now: str) -> Optional[Tuple[Dict, bool]]:
+        sold_out = False
+        with self._tx() as cur:
+            if used_type == "free":
+                cur.execute("UPDATE users SET free_spins = free_spins - 1 WHERE user_id=? AND free_spins > 0", (user_id,))
+            else:
+                cur.execute(
+                    "UPDATE users SET paid_spins = paid_spins - ? WHERE user_id=? AND paid_spins >= ?",
+                    (cost, user_id, cost),
+                )
+            if cur.rowcount != 1:
+                return None
+
+            if outcome.get("limited"):
+                cur.execute("UPDATE gift_stock SET remaining = remaining - 1 WHERE idx=? AND remaining > 0", (outcome["idx"],))
+                if cur.rowcount != 1:
+                    outcome, sold_out = lose, True
+                else:
+                    cur.execute("SELECT remaining FROM gift_stock WHERE idx=?", (outcome["idx"],))
+                    sold_out = cur.fetchone()["remaining"] <= 0
+
+            cur.execute(
+                "INSERT INTO spins(user_id, used_type, result_idx, result_name, result_sticker, created_at) VALUES(?,?,?,?,?,?)",
+                (user_id, used_type, outcome["idx"], outcome["name"], outcome["sticker"] or "", now),
+            )
+        return outcome, sold_out
+
+    def spin_counts(self) -> Dict[int, int]:
+        cur = self._con().execute("SELECT result_idx, COUNT(*) AS n FROM spins GROUP BY result_idx")
+        return {r["result_idx"]: r["n"] for r in cur.fetchall()}
+
+    def load_user_data(self, since: float) -> Dict[int, Tuple[str, float]]:
+        cur = self._con().execute("SELECT user_id, data, updated_at FROM user_data WHERE updated_at >= ?", (since,))
+        return {r["user_id"]: (r["data"], r["updated_at"]) for r in cur.fetchall()}
+
+    def save_user_data(self, batch: Dict[int, Optional[str]], now: float) -> None:
+        upserts = [(uid, data, now) for uid, data in batch.items() if data is not None]
+        deletes = [(uid,) for uid, data in batch.items() if data is None]
+        with self._tx() as cur:
+            if upserts:
+                cur.executemany(
+                    "INSERT INTO user_data(user_id, data, updated_at) VALUES(?,?,?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+                    upserts,
+                )
+            if deletes:
+                cur.executemany("DELETE FROM user_data WHERE user_id=?", deletes)
+
+    def purge_user_data(self, before: float) -> int:
+        return self._con().execute("DELETE FROM user_data WHERE updated_at < ?", (before,)).rowcount
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.config: Dict[str, str] = {}
+        self.users: Dict[int, dict] = {}
+        # referral_count -> ids of users with that many referrals (> 0); the memory
+        # counterpart of the SQLite referral_counts table.
+        self.referral_counts: Dict[int, Set[int]] = {}
+        self.stock: Dict[int, dict] = {}
+        self.spins: List[tuple] = []
+        self.user_data: Dict[int, Tuple[str, float]] = {}
+
+    def init(self, config_defaults: Dict[str, str], gift_count: int) -> None:
+        with self._lock:
+            for k, v in config_defaults.items():
+                self.config.setdefault(k, v)
+            for i in range(1, gift_count + 1):
+                self.stock.setdefault(i, {"idx": i, "capacity": None, "remaining": 0,
+                                          "restock_days": 0, "restocked_at": None})
+
+    def config_all(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self.config)
+
+    def config_set(self, key: str, value: str) -> None:
+        with self._lock:
+            self.config[key] = value
+
+    def ensure_user(self, user_id: int, username: str, first_name: str, now: str) -> dict:
+        with self._lock:
+            row = self.users.get(user_id)
+            if row is None:
+                row = {"user_id": user_id, "referrer_id": None, "free_spins": 0, "paid_spins": 0,
+                       "last_free_date": None, "created_at": now, "referral_count": 0}
+                self.users[user_id] = row
+            row["username"], row["first_name"] = username, first_name
+            return dict(row)
+
+    def get_user(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self.users.get(user_id)
+            return dict(row) if row else None
+
+    def add_spins(self, user_id: int, free: int = 0, paid: int = 0) -> None:
+        with self._lock:
+            row = self.users.get(user_id)
+            if row:
+                row["free_spins"] += free
+                row["paid_spins"] += paid
+
+    def reset_daily_free(self, user_id: int, amount: int, today: str) -> None:
+        with self._lock:
+            row = self.users.get(user_id)
+            if row:
+                row["free_spins"], row["last_free_date"] = amount, today
+
+    def set_referrer_if_empty(self, user_id: int, referrer_id: int) -> bool:
+        with self._lock:
+            row = self.users.get(user_id)
+            if not row or row["referrer_id"] is not None:
+                return False
+            row["referrer_id"] = referrer_id
+            referrer = self.users.get(referrer_id)
+            if referrer:
+                old = referrer["referral_count"]
+                referrer["referral_count"] = old + 1
+                if old > 0:
+                    self.referral_counts[old].discard(referrer_id)
+                    if not self.referral_counts[old]:
+                        del self.referral_counts[old]
+                self.referral_counts.setdefault(old + 1, set()).add(referrer_id)
+            return True
+
+    def top_referrers(self, limit: int) -> List[dict]:
+        with self._lock:
+            top: List[dict] = []
+            for count in sorted(self.referral_counts, reverse=True):
+                if len(top) >= limit:
+                    break
+                for uid in heapq.nsmallest(limit - len(top), self.referral_counts[count]):
+                    r = self.users[uid]
+                    top.append({k: r[k] for k in ("user_id", "username", "first_name", "referral_count")})
+            return top
+
+    def referral_rank(self, user_id: int) -> Optional[int]:
+        with self._lock:
+            row = self.users.get(user_id)
+            if not row or row["referral_count"] <= 0:
+                return None
+            n = row["referral_count"]
+            return 1 + sum(len(ids) for count, ids in self.referral_counts.items() if count > n)
+
+    def load_stock(self) -> Dict[int, dict]:
+        with self._lock:
+            return {idx: dict(row) for idx, row in self.stock.items()}
+
+    def set_gift_stock(self, idx: int, capacity: Optional[int], restock_days: int, now: str) -> None:
+        with self._lock:
+            if idx in self.stock:
+                self.stock[idx].update(capacity=capacity, remaining=capacity or 0,
+                                       restock_days=restock_days, restocked_at=now)
+
+    def restock(self, idx: int, last_restocked_at: Optional[str], now: str) -> bool:
+        with self._lock:
+            row = self.stock.get(idx)
+            if not row or row["restocked_at"] != last_restocked_at:
+                return False
+            row["remaining"], row["restocked_at"] = row["capacity"], now
+            return True
+
+    def commit_spin(self, user_id: int, used_type: str, cost: int, outcome: Dict, lose: Dict,
+                    now: str) -> Optional[Tuple[Dict, bool]]:
+        sold_out = False
+        with self._lock:
+            row = self.users.get(user_id)
+            if row is None:
+                return None
+            if used_type == "free":
+                if row["free_spins"] <= 0:
+                    return None
+                row["free_spins"] -= 1
+            else:
+                if row["paid_spins"] < cost:
+                    return None
+                row["paid_spins"] -= cost
+
+            if outcome.get("limited"):
+                stock = self.stock[outcome["idx"]]
+                if stock["remaining"] <= 0:
+                    outcome, sold_out = lose, True
+                else:
+                    stock["remaining"] -= 1
+                    sold_out = stock["remaining"] <= 0
+
+            self.spins.append((user_id, used_type, outcome["idx"], outcome["name"], outcome["sticker"] or "", now))
+        return outcome, sold_out
+
+    def spin_counts(self) -> Dict[int, int]:
+        counts: Dict[int, int] = {}
+        with self._lock:
+            for s in self.spins:
+                counts[s[2]] = counts.get(s[2], 0) + 1
+        return counts
+
+    def load_user_data(self, since: float) -> Dict[int, Tuple[str, float]]:
+        with self._lock:
+            return {uid: v for uid, v in self.user_data.items() if v[1] >= since}
+
+    def save_user_data(self, batch: Dict[int, Optional[str]], now: float) -> None:
+        with self._lock:
+            for uid, data in batch.items():
+                if data is None:
+                    self.user_data.pop(uid, None)
+                else:
+                    self.user_data[uid] = (data, now)
+
+    def purge_user_data(self, before: float) -> int:
+        with self._lock:
+            stale = [uid for uid, v in self.user_data.items() if v[1] < before]
+            for uid in stale:
+                del self.user_data[uid]
+            return len(stale)
+
+
+def open_storage(backend: str, path: str = "") -> Storage:
+    backend = (backend or "sqlite").strip().lower()
+    if backend == "sqlite":
+        return SQLiteStorage(path)
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {backend!r} (use 'sqlite' or 'memory')")